@@ -1,16 +1,48 @@
+from contextlib import nullcontext
+
 from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
-from models.diffusion.unet_diffusion import AttentionBlock, ResBlock, TimestepEmbedSequential, \
+from models.diffusion.unet_diffusion import AttentionBlock, QKVAttention, ResBlock, TimestepEmbedSequential, \
     Downsample, Upsample
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch import autocast
 
 from models.audio.tts.mini_encoder import AudioMiniEncoder
 from trainer.networks import register_model
 
 
+class SDPAAttentionBlock(AttentionBlock):
+    """
+    AttentionBlock which routes the attention math through F.scaled_dot_product_attention so torch can
+    dispatch to a fused (flash / memory-efficient) kernel instead of materializing the full NxN score
+    matrix. Falls back to the stock path when a mask is given or on torch builds without SDPA.
+    """
+    def _forward(self, x, mask):
+        if mask is not None or not hasattr(F, 'scaled_dot_product_attention'):
+            return super()._forward(x, mask)
+        b, c, *spatial = x.shape
+        x = x.reshape(b, c, -1)
+        qkv = self.qkv(self.norm(x))
+        length = qkv.shape[-1]
+        head_dim = c // self.num_heads
+        if isinstance(self.attention, QKVAttention):
+            q, k, v = [t.reshape(b, self.num_heads, head_dim, length) for t in qkv.chunk(3, dim=1)]
+        else:
+            q, k, v = qkv.reshape(b, self.num_heads, 3 * head_dim, length).chunk(3, dim=2)
+        h = F.scaled_dot_product_attention(q.transpose(-1, -2), k.transpose(-1, -2), v.transpose(-1, -2))
+        h = h.transpose(-1, -2).reshape(b, c, length)
+        h = self.proj_out(h)
+        return (x + h).reshape(b, c, *spatial)
+
+
 class DiscreteSpectrogramConditioningBlock(nn.Module):
-    def __init__(self, dvae_channels, channels, level):
+    def __init__(self, dvae_channels, channels, level, shared_embedder=None):
         super().__init__()
+        # When several conditioning blocks are used at different levels, a single embedder stage can be
+        # shared between them (weight-tying style); each level then only owns its projection to the
+        # channel count of that level.
+        self.shared_embedder = shared_embedder
         self.intg = nn.Sequential(nn.Conv1d(dvae_channels, channels, kernel_size=1),
                                   normalization(channels),
                                   nn.SiLU(),
@@ -26,8 +58,16 @@ class DiscreteSpectrogramConditioningBlock(nn.Module):
     def forward(self, x, dvae_in):
         b, c, S = x.shape
         _, q, N = dvae_in.shape
+        if self.shared_embedder is not None:
+            dvae_in = self.shared_embedder(dvae_in)
         emb = self.intg(dvae_in)
-        emb = nn.functional.interpolate(emb, size=(S,), mode='nearest')
+        if S % emb.shape[-1] == 0:
+            # The spectrogram grid always divides the waveform latent evenly, so nearest-neighbor
+            # upsampling is just an integer tiling; repeat_interleave is a plain strided copy and fuses
+            # far better than the generic interpolate kernel.
+            emb = emb.repeat_interleave(S // emb.shape[-1], dim=2)
+        else:
+            emb = nn.functional.interpolate(emb, size=(S,), mode='nearest')
         return torch.cat([x, emb], dim=1)
 
 
@@ -90,6 +130,7 @@ class DiffusionVocoderWithRef(nn.Module):
             conditioning_inputs_provided=True,
             conditioning_input_dim=80,
             time_embed_dim_multiplier=4,
+            share_conditioning_embedder=False,
             freeze_layers_below=None,  # powers of 2; ex: 1,2,4,8,16,32,etc..
     ):
         super().__init__()
@@ -105,6 +146,7 @@ class DiffusionVocoderWithRef(nn.Module):
         self.channel_mult = channel_mult
         self.conv_resample = conv_resample
         self.dtype = torch.float16 if use_fp16 else torch.float32
+        self.enable_fp16 = use_fp16
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
@@ -123,6 +165,11 @@ class DiffusionVocoderWithRef(nn.Module):
         if conditioning_inputs_provided:
             self.contextual_embedder = AudioMiniEncoder(in_channels, time_embed_dim, base_channels=32, depth=6, resnet_blocks=1,
                              attn_blocks=2, num_attn_heads=2, dropout=dropout, downsample_factor=4, kernel_size=5)
+            self._cached_conditioning_key = None
+            self._cached_conditioning_emb = None
+        # Specialize forward() at construction time. conditioning_enabled never changes after __init__, so
+        # re-testing it every diffusion timestep is wasted work (and a graph break under torch.compile).
+        self.forward = self._forward_cond if conditioning_inputs_provided else self._forward_nocond
 
         seqlyr = TimestepEmbedSequential(
             conv_nd(dims, in_channels, model_channels, kernel_size, padding=padding)
@@ -135,9 +182,15 @@ class DiffusionVocoderWithRef(nn.Module):
         ch = model_channels
         ds = 1
 
+        shared_cond_embedder = None
+        if share_conditioning_embedder:
+            shared_cond_embedder = nn.Sequential(nn.Conv1d(discrete_codes, discrete_codes, kernel_size=1),
+                                                 nn.SiLU())
+
         for level, (mult, num_blocks) in enumerate(zip(channel_mult, num_res_blocks)):
             if ds in spectrogram_conditioning_resolutions:
-                spec_cond_block = DiscreteSpectrogramConditioningBlock(discrete_codes, ch, 2 ** level)
+                spec_cond_block = DiscreteSpectrogramConditioningBlock(discrete_codes, ch, 2 ** level,
+                                                                       shared_embedder=shared_cond_embedder)
                 self.input_blocks.append(spec_cond_block)
                 spectrogram_blocks.append(spec_cond_block)
                 ch *= 2
@@ -157,7 +210,7 @@ class DiffusionVocoderWithRef(nn.Module):
                 ch = int(mult * model_channels)
                 if ds in attention_resolutions:
                     layers.append(
-                        AttentionBlock(
+                        SDPAAttentionBlock(
                             ch,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
@@ -203,7 +256,7 @@ class DiffusionVocoderWithRef(nn.Module):
                 use_scale_shift_norm=use_scale_shift_norm,
                 kernel_size=kernel_size,
             ),
-            AttentionBlock(
+            SDPAAttentionBlock(
                 ch,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
@@ -238,7 +291,7 @@ class DiffusionVocoderWithRef(nn.Module):
                 ch = int(model_channels * mult)
                 if ds in attention_resolutions:
                     layers.append(
-                        AttentionBlock(
+                        SDPAAttentionBlock(
                             ch,
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
@@ -299,28 +352,81 @@ class DiffusionVocoderWithRef(nn.Module):
                     unfrozen_params += 1
             print(f"freeze_layers_below specified. Training a total of {unfrozen_params} parameters.")
 
-    def forward(self, x, timesteps, spectrogram, conditioning_input=None):
+    def _forward_cond(self, x, timesteps, spectrogram, conditioning_input=None):
         """
-        Apply the model to an input batch.
+        Apply the model to an input batch. Bound to forward() in __init__ when conditioning is enabled.
 
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
-        :param y: an [N] Tensor of labels, if class-conditional.
+        :param spectrogram: the conditioning spectrogram prior.
+        :param conditioning_input: a reference clip (or a stack of them) to derive the voice from.
         :return: an [N x C x ...] Tensor of outputs.
         """
-        assert x.shape[-1] % 2048 == 0  # This model operates at base//2048 at it's bottom levels, thus this requirement.
-        if self.conditioning_enabled:
-            assert conditioning_input is not None
+        with self._inference_ctx(), autocast(x.device.type, enabled=self.enable_fp16):
+            emb = self._embed_timesteps(timesteps)
+            emb2 = self._embed_conditioning(conditioning_input)
+            return self._forward_torso(x, emb + emb2, spectrogram)
+
+    def _inference_ctx(self):
+        # Sampling calls arrive in eval mode with grads already disabled; upgrade those to
+        # inference_mode, which additionally skips autograd view/version tracking on every intermediate.
+        if not self.training and not torch.is_grad_enabled():
+            return torch.inference_mode()
+        return nullcontext()
+
+    def _embed_timesteps(self, timesteps):
+        """
+        Samplers generally feed the same timestep for every batch element, so at eval time the embedding
+        (and the time_embed MLP behind it) is computed on the unique values only and gathered back out.
+        Training batches draw random timesteps and take the direct path.
+        """
+        if not self.training and timesteps.shape[0] > 1:
+            unique_t, inv = torch.unique(timesteps, return_inverse=True)
+            if unique_t.shape[0] < timesteps.shape[0]:
+                return self.time_embed(timestep_embedding(unique_t, self.model_channels))[inv]
+        return self.time_embed(timestep_embedding(timesteps, self.model_channels))
 
-        hs = []
-        emb1 = self.time_embed(timestep_embedding(timesteps, self.model_channels))
-        if self.conditioning_enabled:
-            emb2 = self.contextual_embedder(conditioning_input)
-            emb = emb1 + emb2
+    def _embed_conditioning(self, conditioning_input):
+        """
+        The conditioning embedding depends only on the reference clip(s), which diffusion samplers pass
+        in unchanged at every timestep; at eval time the embedding is cached and reused for as long as
+        the same tensor keeps coming back.
+        """
+        assert conditioning_input is not None
+        # Only cache in the sampling regime (eval + grads globally off, mirroring _inference_ctx).
+        # Caching a graph-carrying tensor would pin the whole embedder graph in memory, and replaying
+        # an inference-mode tensor into a grad-enabled call would fail outright.
+        cacheable = not self.training and not torch.is_grad_enabled()
+        if cacheable and self._cached_conditioning_key is conditioning_input:
+            return self._cached_conditioning_emb
+        if len(conditioning_input.shape) == 4:
+            # Multiple conditioning clips provided as (b,n,c,t). Rather than looping the embedder over
+            # each clip, fold the clip dim into the batch dim so everything is embedded in a single
+            # call, then average the per-clip embeddings.
+            b, n = conditioning_input.shape[:2]
+            emb2 = self.contextual_embedder(conditioning_input.reshape(b * n, *conditioning_input.shape[2:]))
+            emb2 = emb2.reshape(b, n, -1).mean(dim=1)
         else:
-            emb = emb1
+            emb2 = self.contextual_embedder(conditioning_input)
+        if cacheable:
+            self._cached_conditioning_key = conditioning_input
+            self._cached_conditioning_emb = emb2
+        return emb2
 
-        h = x.type(self.dtype)
+    def _forward_nocond(self, x, timesteps, spectrogram, conditioning_input=None):
+        """
+        Unconditioned variant of the above; bound to forward() when conditioning_inputs_provided=False.
+        """
+        with self._inference_ctx(), autocast(x.device.type, enabled=self.enable_fp16):
+            emb = self._embed_timesteps(timesteps)
+            return self._forward_torso(x, emb, spectrogram)
+
+    def _forward_torso(self, x, emb, spectrogram):
+        assert x.shape[-1] % 2048 == 0  # This model operates at base//2048 at it's bottom levels, thus this requirement.
+        hs = []
+        # No input cast here: autocast (see the forward variants) downcasts at the first conv when fp16
+        # is enabled, so an eager per-timestep copy of x would be pure overhead.
+        h = x
         for k, module in enumerate(self.input_blocks):
             if isinstance(module, DiscreteSpectrogramConditioningBlock):
                 h = module(h, spectrogram)
@@ -331,8 +437,11 @@ class DiffusionVocoderWithRef(nn.Module):
         for module in self.output_blocks:
             h = torch.cat([h, hs.pop()], dim=1)
             h = module(h, emb)
-        h = h.type(x.dtype)
-        return self.out(h)
+        # Keep the output projection out of autocast (same as unet_diffusion_tts9): the variance head
+        # wants full precision, and callers should get back the dtype they passed in.
+        with autocast(x.device.type, enabled=False):
+            h = h.type(x.dtype)
+            return self.out(h)
 
 
 def move_all_layers_down(pretrained_path, output_path, layers_to_be_added=3):
@@ -354,7 +463,20 @@ def move_all_layers_down(pretrained_path, output_path, layers_to_be_added=3):
 
 @register_model
 def register_unet_diffusion_vocoder_with_ref(opt_net, opt):
-    return DiffusionVocoderWithRef(**opt_net['kwargs'])
+    kwargs = opt_net['kwargs']
+    do_compile = kwargs.pop('torch_compile', False)
+    model = DiffusionVocoderWithRef(**kwargs)
+    if do_compile and hasattr(torch, 'compile'):
+        # PyTorch has no channels_last layout for 1-d convs, but Inductor still prefers densely packed
+        # parameter strides, so make any non-contiguous weights (e.g. from checkpoint surgery) dense
+        # before compiling.
+        for p in model.parameters():
+            if not p.data.is_contiguous():
+                p.data = p.data.contiguous()
+        # Diffusion sampling calls this model hundreds of times with identical shapes, so the
+        # compile cost is quickly amortized away.
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+    return model
 
 
 # Test for ~4 second audio clip at 22050Hz
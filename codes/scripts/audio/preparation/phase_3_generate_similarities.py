@@ -2,99 +2,205 @@ import argparse
 import functools
 import os
 import sys
-from multiprocessing.pool import ThreadPool
+from queue import Queue
+from threading import Thread
 
 import torch
 import torch.nn.functional as F
 import yaml
+from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
 
 from data.audio.unsupervised_audio_dataset import load_audio
 from data.util import is_audio_file
-from scripts.audio.gen.speech_synthesis_utils import wav_to_mel
+from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector
 from utils.options import Loader
 from utils.util import load_model_from_config
 
 clip_model = None
+clip_fn = None
 
 
 def recursively_find_audio_directories(root):
-    subdirs = []
-    audio_files = []
-    for f in os.scandir(root):
-        if f.is_dir():
-            subdirs.append(f)
-        elif is_audio_file(f.path):
-            audio_files.append(f.path)
-    assert len(subdirs) == 0 or len(audio_files) == 0
-    if len(subdirs) > 0:
-        res = []
-        for subdir in subdirs:
-            res.extend(recursively_find_audio_directories(subdir.path))
-        return res
-    return [(root, audio_files)]
+    # os.walk performs a single scandir per directory, where the old recursive implementation
+    # re-stat'ed every entry at each level of the tree.
+    res = []
+    for base, dirs, files in os.walk(root):
+        audio_files = [os.path.join(base, f) for f in files if is_audio_file(f)]
+        assert len(dirs) == 0 or len(audio_files) == 0
+        if len(dirs) == 0:
+            res.append((base, audio_files))
+    return res
+
+
+def _load_clip(path, sampling_rate, clip_sz):
+    """
+    Decodes just the head of an audio file with torchaudio's StreamReader, which stops pulling packets
+    once clip_sz output samples have been produced instead of decoding (and resampling) the whole file.
+    Falls back to the stock load_audio on torchaudio builds without the streaming API or on files it
+    cannot open.
+    """
+    try:
+        from torchaudio.io import StreamReader
+    except ImportError:
+        return load_audio(str(path), sampling_rate)[0, :clip_sz]
+    try:
+        reader = StreamReader(str(path))
+        reader.add_basic_audio_stream(frames_per_chunk=clip_sz, sample_rate=sampling_rate)
+        chunks = []
+        loaded = 0
+        for (chunk,) in reader.stream():
+            chunks.append(chunk[:, 0])
+            loaded += chunk.shape[0]
+            if loaded >= clip_sz:
+                break
+        return torch.cat(chunks)[:clip_sz].clip(-1, 1)
+    except Exception:
+        return load_audio(str(path), sampling_rate)[0, :clip_sz]
+
+
+def _pad_clip_batch(clips, clip_sz):
+    batch = pad_sequence(clips, batch_first=True)
+    if batch.shape[1] < clip_sz:
+        batch = F.pad(batch, (0, clip_sz - batch.shape[1]))
+    return batch.unsqueeze(1)
+
+
+def _produce_clip_batches(paths, clip_sz, batch_sz, out_queue):
+    """
+    Loader for process_subdir, run on a background thread so the CPU decodes and pads the next batch of
+    clips while the GPU is busy scoring the current one. Pushes (consumed, paths, batch) tuples followed
+    by a None sentinel; paths are reported alongside the batch because unreadable clips are dropped, and
+    consumed counts every input path attempted so far so the consumer can checkpoint its progress.
+    """
+    clips = []
+    batch_paths = []
+    try:
+        for consumed, path in enumerate(paths, start=1):
+            try:
+                clips.append(_load_clip(path, 22050, clip_sz))
+                batch_paths.append(path)
+            except:
+                print(f"Error processing {path}. Recovering gracefully.")
+                print(sys.exc_info())
+            if len(clips) == batch_sz:
+                out_queue.put((consumed, batch_paths, _pad_clip_batch(clips, clip_sz)))
+                clips = []
+                batch_paths = []
+        if len(clips) > 0:
+            out_queue.put((len(paths), batch_paths, _pad_clip_batch(clips, clip_sz)))
+    finally:
+        # Always deliver the sentinel, even if padding/stacking blows up above - otherwise the consumer
+        # blocks on the queue forever.
+        out_queue.put(None)
 
 
 def process_subdir(subdir, options, clip_sz):
-    global clip_model
+    global clip_model, clip_fn
     if clip_model is None:
         print('Loading CLIP model..')
         clip_model = load_model_from_config(preloaded_options=options, model_name='clip', also_load_savepoint=True).cuda()
         clip_model.eval()
-
-    with torch.no_grad():
+        # Build the MEL injector once (wav_to_mel constructs it - and re-reads the norms file - on every
+        # call) and fuse wav->mel->similarity into one callable so torch.compile can optimize across the
+        # boundary.
+        mel_injector = TorchMelSpectrogramInjector({'in': 'wav', 'out': 'mel',
+                                                    'mel_norm_file': '../experiments/clips_mel_norms.pth'}, {})
+
+        def _wav_to_similarity(wav):
+            return clip_model.inference(mel_injector({'wav': wav})['mel'])
+        clip_fn = torch.compile(_wav_to_similarity) if hasattr(torch, 'compile') else _wav_to_similarity
+
+    # inference_mode is a stronger no_grad: it also skips view/version-counter tracking on every
+    # intermediate tensor, and nothing produced here ever re-enters autograd.
+    with torch.inference_mode():
         root, paths = subdir
         if len(paths) == 0:
             return
         root = str(root)
         output_file = os.path.join(root, 'similarities.pth')
         if os.path.exists(output_file):
-            print(f'{root} already processed. Skipping.')
-            return
+            # Only trust an existing similarities file if no clip was added or modified after it was
+            # written; otherwise redo the directory.
+            produced = os.path.getmtime(output_file)
+            if all(os.path.getmtime(p) <= produced for p in paths):
+                print(f'{root} already processed. Skipping.')
+                return
+            print(f'{root} has clips newer than its similarities file. Reprocessing.')
         print(f'Processing {root}..')
 
-        clips = []
-        for path in paths:
+        partial_file = output_file + '.partial'
+        resume_at = 0
+        loaded_paths = []
+        sims = None
+        if os.path.exists(partial_file):
+            # A previous run died partway through this directory; pick up at the last completed batch
+            # as long as no clip changed after the partial state was written.
             try:
-                clip = load_audio(str(path), 22050)
-                padding = clip_sz - clip.shape[1]
-                if padding > 0:
-                    clip = F.pad(clip, (0, padding))
-                elif padding < 0:
-                    clip = clip[:, :clip_sz]
-                clips.append(clip)
+                if all(os.path.getmtime(p) <= os.path.getmtime(partial_file) for p in paths):
+                    state = torch.load(partial_file)
+                    resume_at, loaded_paths, sims = state['consumed'], state['loaded_paths'], state['sims']
+                    print(f'Resuming {root} at clip {resume_at}/{len(paths)}.')
             except:
-                print(f"Error processing {path}. Recovering gracefully.")
-                print(sys.exc_info())
-        sims = None
-        while len(clips) > 0:
-            stacked = torch.stack(clips[:256], dim=0).cuda()
-            clips = clips[256:]
-            mels = wav_to_mel(stacked).cuda()
-            outp = clip_model.inference(mels).cpu()
+                print(f'Could not read partial state for {root}. Restarting it.')
+                resume_at, loaded_paths, sims = 0, [], None
+
+        batch_queue = Queue(maxsize=2)
+        # daemon: if the consumer dies (e.g. OOM during inference), the loader may be blocked on a full
+        # queue; it must not keep the worker process alive.
+        loader = Thread(target=_produce_clip_batches, args=(paths[resume_at:], clip_sz, 256, batch_queue), daemon=True)
+        loader.start()
+        for consumed, batch_paths, stacked in iter(batch_queue.get, None):
+            loaded_paths.extend(batch_paths)
+            stacked = stacked.cuda()
+            if sims is not None and stacked.shape[0] < 256:
+                # Pad the tail batch up to the fixed 256 on the input side: the model then always sees
+                # one static shape (no recompile / new cudnn plan for the last batch) and the output
+                # needs no post-hoc padding.
+                stacked = F.pad(stacked, (0, 0, 0, 0, 0, 256 - stacked.shape[0]))
+            outp = clip_fn(stacked).cpu()
+            if outp.shape[0] > len(batch_paths):
+                # Slicing removes the filler rows, but the filler *columns* must be masked out too: the
+                # model L2-normalizes its latents, so the embedding of an all-zero clip is a legitimate
+                # unit vector and its similarities could otherwise win the topk.
+                outp[:, len(batch_paths):] = float('-inf')
+            outp = outp[:len(batch_paths)]
             if sims is None:
                 sims = outp
             else:
-                if outp.shape[-1] != 256:
-                    outp = F.pad(outp, (0,256-outp.shape[-1]))
                 sims = torch.cat([sims, outp], dim=0)
+            # Checkpoint after every batch so an interrupted run costs one batch, not the directory.
+            # loaded_paths is persisted alongside sims to keep dropped-clip indexing intact on resume.
+            torch.save({'consumed': resume_at + consumed, 'loaded_paths': loaded_paths, 'sims': sims},
+                       partial_file)
+        loader.join()
+        if sims is None:
+            return
 
         simmap = {}
         # TODO: this can be further improved. We're just taking the topk here but, there is no gaurantee that there is 3
         # samples from the same speaker in any given folder.
-        for path, sim in zip(paths, sims):
-            n = min(4, len(sim))
-            top3 = torch.topk(sim, n)
-            rel = os.path.relpath(str(path), root)
-            simpaths = []
-            if n == 1:
-                simpaths.append(rel)
-            else:
-                for i in range(1,n):  # The first entry is always the file itself.
-                    top_ind = top3.indices[i]
-                    simpaths.append(str(os.path.relpath(paths[top_ind], root)).replace('\\', '/'))
-            simmap[rel] = simpaths
+        n = min(4, sims.shape[1])
+        # A single batched topk over all rows; sorted=False skips the final sort kernel since the
+        # self-match is dropped by index below instead of relying on it ranking first.
+        top_inds = torch.topk(sims, n, dim=1, sorted=False).indices.tolist()
+        # relpath is surprisingly expensive (it re-splits and normalizes both arguments every call), so
+        # compute it once per clip instead of once per (clip, neighbor) pair.
+        rel_keys = [os.path.relpath(str(p), root) for p in loaded_paths]
+        rel_vals = [rk.replace('\\', '/') for rk in rel_keys]
+        for row, inds in enumerate(top_inds):
+            rel = rel_keys[row]
+            # inference() scores each batch of 256 against itself, so the topk indices are columns
+            # *within the row's own batch*: rebase them onto the global clip list, and drop the
+            # self-match by its within-batch column rather than relying on sort order.
+            base = (row // 256) * 256
+            # Tail rows with fewer than n real columns still get n indices back from topk, so some of
+            # them point at the -inf filler columns; skip those instead of indexing past rel_vals.
+            simpaths = [rel_vals[base + i] for i in inds if i != row - base and base + i < len(rel_vals)][:n-1]
+            simmap[rel] = simpaths if len(simpaths) > 0 else [rel]
         torch.save(simmap, output_file)
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
 
 
 if __name__ == '__main__':
@@ -119,8 +225,11 @@ if __name__ == '__main__':
     print(f"Found {len(all_files)}. Processing.")
     fn = functools.partial(process_subdir, options=opt, clip_sz=args.clip_size)
     if args.num_workers > 1:
-        with ThreadPool(args.num_workers) as pool:
-            tqdm(list(pool.imap(fn, all_files)), total=len(all_files))
+        # Use real processes rather than a ThreadPool: the model forward holds the GIL for the Python
+        # parts of the pipeline, so threads mostly serialized. spawn is required for CUDA; each worker
+        # lazily loads its own copy of the CLIP model.
+        with torch.multiprocessing.get_context('spawn').Pool(args.num_workers) as pool:
+            list(tqdm(pool.imap(fn, all_files), total=len(all_files)))
     else:
         for subdir in tqdm(all_files):
             fn(subdir)